@@ -3,96 +3,355 @@ Dapr MCP AI Agent POC
 A natural language chatbot using Dapr Agents + Chainlit that queries multiple DBs via MCP.
 """
 
+import asyncio
+import functools
+import hashlib
+import logging
 import os
+import sys
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
 from pathlib import Path
 from typing import Optional
 
 import chainlit as cl
 from dotenv import load_dotenv
 from dapr_agents import Agent
+from dapr_agents.agents.configs import AgentMemoryConfig
+from dapr_agents.memory import MemoryBase
 from dapr_agents.tool.mcp.client import MCPClient
 from dapr_agents.llm.dapr import DaprChatClient
+from dapr_agents.types import AgentError
 
 load_dotenv()
 
-# MCP Server Configuration
-CB_MCP_SERVER_URL = os.getenv("CB_MCP_SERVER_URL", "http://localhost:8000/sse")
-PG_MCP_SERVER_URL = os.getenv("PG_MCP_SERVER_URL", "http://localhost:8003/sse")
-CB_MCP_ACTIVE = os.getenv("CB_MCP_ACTIVE", "true").lower() == "true"
-PG_MCP_ACTIVE = os.getenv("PG_MCP_ACTIVE", "true").lower() == "true"
-CB_BUCKET_NAME = os.getenv("CB_BUCKET_NAME", "travel-sample")
+logger = logging.getLogger(__name__)
 
-# Global state
-agent: Optional[Agent] = None
+# Prompt files
+PROMPTS_DIR = Path(__file__).resolve().parent / "prompts"
+_SYSTEM_PROMPT_PATH = PROMPTS_DIR / "system_prompt.txt"
+_CB_PROMPT_PATH = PROMPTS_DIR / "couchbase_prompt.txt"
+
+
+@dataclass(frozen=True, slots=True)
+class AppConfig:
+    """Environment-driven settings, replaced as a whole on Reload Env."""
+    cb_url: str
+    pg_url: str
+    cb_active: bool
+    pg_active: bool
+    bucket: str
+    llm_component: str
+    llm_provider: str
+
+
+_TRUE_VALUES = frozenset({"1", "true", "yes", "on", "y", "t"})
+
+
+def _as_bool(value: Optional[str], default: bool = True) -> bool:
+    """Parse an env flag; unset falls back to ``default``."""
+    if value is None:
+        return default
+    return value.strip().casefold() in _TRUE_VALUES
+
+
+def load_config() -> AppConfig:
+    """Read the app settings from the environment."""
+    return AppConfig(
+        cb_url=os.getenv("CB_MCP_SERVER_URL", "http://localhost:8000/sse"),
+        pg_url=os.getenv("PG_MCP_SERVER_URL", "http://localhost:8003/sse"),
+        cb_active=_as_bool(os.getenv("CB_MCP_ACTIVE")),
+        pg_active=_as_bool(os.getenv("PG_MCP_ACTIVE")),
+        bucket=os.getenv("CB_BUCKET_NAME", "travel-sample"),
+        llm_component=os.getenv("DAPR_LLM_COMPONENT_DEFAULT", "openai"),
+        llm_provider=os.getenv("DAPR_LLM_PROVIDER", "openai")
+    )
+
+
+# Current configuration
+_cfg = load_config()
+
+# Global state (the Agent itself lives in each Chainlit user session)
 cb_mcp_client: Optional[MCPClient] = None
 pg_mcp_client: Optional[MCPClient] = None
 
+# MCP clients are shared by all chat sessions and connected once
+_mcp_lock = asyncio.Lock()
+_mcp_ready = asyncio.Event()
+
+# Bumped on every (re)connect; agents built on an older value hold stale tools
+_mcp_generation = 0
 
+# Shared LLM client, keyed by the (component, provider) it was built for
+_llm: Optional[DaprChatClient] = None
+_llm_config: Optional[tuple] = None
+
+# How long on_message waits before saying the answer will arrive later. This is
+# only a soft bound: each LLM call is a blocking generate(), so the timeout can
+# only fire between calls and a turn may overrun it by a whole LLM call.
+AGENT_RUN_TIMEOUT = 175
+
+# Background MCP connect started on app startup
+_warmup_task: Optional[asyncio.Task] = None
+
+# In-flight agent run per Chainlit session id. Holds strong refs to runs that
+# outlive their on_message handler; a session never gets a second concurrent
+# run, since both would write into the same agent memory.
+_pending_runs: "dict[str, asyncio.Future]" = {}
+
+# Exact-match LRU cache of first-turn answers, keyed by response_cache_key().
+# Entries expire after RESPONSE_CACHE_TTL seconds since they reflect live DB data.
+RESPONSE_CACHE_SIZE = 512
+RESPONSE_CACHE_TTL = 300
+_resp_cache: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+
+# Appended by dapr_agents when a run gives up - never replay it from cache
+_MAX_STEPS_NOTICE = "I reached the maximum number of reasoning steps"
+
+
+@functools.lru_cache(maxsize=1)
 def load_system_prompt() -> str:
-    """Load system prompt, adding DB-specific prompts if active."""
-    prompts_dir = Path(__file__).parent / "prompts"
-    
+    """Load system prompt, adding DB-specific prompts if active.
+
+    Cached for the process lifetime; call ``load_system_prompt.cache_clear()``
+    when the config it depends on (``cb_active``) changes.
+    """
     # Base system prompt
-    prompt = (prompts_dir / "system_prompt.txt").read_text(encoding="utf-8")
+    parts = [_SYSTEM_PROMPT_PATH.read_bytes()]
     
     # Add Couchbase-specific prompt if active
-    if CB_MCP_ACTIVE:
-        cb_prompt_file = prompts_dir / "couchbase_prompt.txt"
-        if cb_prompt_file.exists():
-            prompt += "\n\n" + cb_prompt_file.read_text(encoding="utf-8")
+    if _cfg.cb_active:
+        try:
+            parts.append(_CB_PROMPT_PATH.read_bytes())
+        except FileNotFoundError:
+            pass
     
-    return prompt
+    # Join the raw bytes and decode once
+    return b"\n\n".join(parts).decode("utf-8")
 
 
-async def init_agent():
-    """Initialize or reset the agent with MCP connections."""
-    global agent, cb_mcp_client, pg_mcp_client
+@functools.lru_cache(maxsize=1)
+def system_prompt_digest() -> bytes:
+    """Digest of the active system prompt, used in response cache keys.
+    
+    Cleared together with ``load_system_prompt.cache_clear()``.
+    """
+    return hashlib.blake2b(load_system_prompt().encode("utf-8"), digest_size=16).digest()
+
+
+# Build the prompt once at import. Every agent then sends a byte-identical
+# system prefix, which the LLM provider's automatic prompt caching relies on.
+load_system_prompt()
+system_prompt_digest()
+
+
+async def close_mcp_clients():
+    """Close active MCP clients concurrently, ignoring teardown errors."""
+    await asyncio.gather(
+        *(client.close() for client in (cb_mcp_client, pg_mcp_client) if client),
+        return_exceptions=True
+    )
+
+
+async def connect_mcp_clients():
+    """(Re)connect the shared MCP clients. Caller must hold ``_mcp_lock``."""
+    global cb_mcp_client, pg_mcp_client, _mcp_generation
+    cfg = _cfg
+    
+    _mcp_ready.clear()
+    _mcp_generation += 1
+    
+    # Tools (or the prompt, on reload) may change - drop cached answers
+    _resp_cache.clear()
     
     # Cleanup existing connections
-    for client in [cb_mcp_client, pg_mcp_client]:
-        if client:
-            try:
-                await client.close()
-            except RuntimeError:
-                pass
+    await close_mcp_clients()
     cb_mcp_client = None
     pg_mcp_client = None
-    agent = None
     
-    # Connect to Couchbase MCP if active
-    if CB_MCP_ACTIVE:
-        cb_mcp_client = MCPClient(persistent_connections=True)
-        await cb_mcp_client.connect_sse(server_name="couchbase", url=CB_MCP_SERVER_URL)
+    # Check if at least one DB is available
+    if not cfg.cb_active and not cfg.pg_active:
+        raise RuntimeError("No DB available - both CB_MCP_ACTIVE and PG_MCP_ACTIVE are false")
     
-    # Connect to PostgreSQL MCP if active
-    if PG_MCP_ACTIVE:
+    # Connect to active MCP servers concurrently
+    connects = []
+    if cfg.cb_active:
+        cb_mcp_client = MCPClient(persistent_connections=True)
+        connects.append(asyncio.ensure_future(
+            cb_mcp_client.connect_sse(server_name="couchbase", url=cfg.cb_url)
+        ))
+    if cfg.pg_active:
         pg_mcp_client = MCPClient(persistent_connections=True)
-        await pg_mcp_client.connect_sse(server_name="postgres", url=PG_MCP_SERVER_URL)
+        connects.append(asyncio.ensure_future(
+            pg_mcp_client.connect_sse(server_name="postgres", url=cfg.pg_url)
+        ))
+    try:
+        await asyncio.gather(*connects)
+    except BaseException:
+        # gather() leaves the other connect running - stop it before cleanup
+        for connect in connects:
+            connect.cancel()
+        await asyncio.gather(*connects, return_exceptions=True)
+        await close_mcp_clients()
+        cb_mcp_client = None
+        pg_mcp_client = None
+        raise
     
-    # Check if at least one DB is available
-    if not CB_MCP_ACTIVE and not PG_MCP_ACTIVE:
-        raise RuntimeError("No DB available - both CB_MCP_ACTIVE and PG_MCP_ACTIVE are false")
+    _mcp_ready.set()
+
+
+async def ensure_mcp_clients():
+    """Connect the shared MCP clients once per process."""
+    if _mcp_ready.is_set():
+        return
+    async with _mcp_lock:
+        if not _mcp_ready.is_set():
+            await connect_mcp_clients()
+
+
+async def reset_mcp_clients():
+    """Force a reconnect of the shared MCP clients."""
+    async with _mcp_lock:
+        await connect_mcp_clients()
+
+
+def response_cache_key(prompt: str) -> str:
+    """Hash a normalized user prompt together with the active system prompt."""
+    normalized = " ".join(prompt.split()).lower()
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(system_prompt_digest())
+    digest.update(normalized.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def get_cached_response(key: str) -> Optional[str]:
+    """Return a cached, unexpired answer and mark it as recently used."""
+    entry = _resp_cache.get(key)
+    if entry is None:
+        return None
+    expires_at, content = entry
+    if expires_at < time.monotonic():
+        del _resp_cache[key]
+        return None
+    _resp_cache.move_to_end(key)
+    return content
+
+
+def cache_response(key: str, content: str):
+    """Store an answer, evicting the least recently used one when full."""
+    if _MAX_STEPS_NOTICE in content:
+        return
+    _resp_cache[key] = (time.monotonic() + RESPONSE_CACHE_TTL, content)
+    _resp_cache.move_to_end(key)
+    if len(_resp_cache) > RESPONSE_CACHE_SIZE:
+        _resp_cache.popitem(last=False)
+
+
+def get_llm() -> DaprChatClient:
+    """Return the shared Dapr chat client, rebuilding it only if its config changed."""
+    global _llm, _llm_config
+    
+    config = (_cfg.llm_component, _cfg.llm_provider)
+    if _llm is None or config != _llm_config:
+        component_name, provider = config
+        _llm = DaprChatClient(component_name=component_name, provider=provider, timeout=180)
+        _llm_config = config
+    return _llm
+
+
+def cache_run_result(key: str, generation: int, run: asyncio.Future):
+    """Done-callback for an agent run: cache its answer if it produced one.
+    
+    Answers from runs that started before the last MCP reconnect are dropped.
+    """
+    if run.cancelled() or run.exception() is not None:
+        return
+    if generation != _mcp_generation:
+        return
+    response = run.result()
+    if response and response.content:
+        cache_response(key, response.content)
+
+
+async def answer_into(agent: Agent, question: str, msg: cl.Message):
+    """Run the agent and write its answer into ``msg``, however long it takes.
     
+    Runs as its own task, so an answer that arrives after on_message stopped
+    waiting still fills in the message of the session that asked.
+    """
+    try:
+        response = await agent.run(question)
+        msg.content = (response and response.content) or "No response generated."
+    except AgentError as e:
+        # LLM/tool-loop failures (Agent.run already logs them)
+        msg.content = f"Error: {e}"
+        response = None
+    except Exception:
+        # Anything unexpected is left to Chainlit; don't leave the placeholder empty
+        msg.content = "❌ Unexpected error while answering."
+        await msg.update()
+        raise
+    await msg.update()
+    return response
+
+
+def build_agent(memory: Optional[MemoryBase] = None) -> Agent:
+    """Build an agent over the tools of the shared MCP clients.
+    
+    Pass ``memory`` to carry an existing conversation over to the new agent.
+    Per-DB tool counts are stored in the user session as ``tool_counts`` and
+    the connection generation the tools belong to as ``mcp_generation``.
+    """
     # Collect tools from active MCP clients
-    all_tools = []
-    if cb_mcp_client:
-        all_tools.extend(cb_mcp_client.get_all_tools())
-    if pg_mcp_client:
-        all_tools.extend(pg_mcp_client.get_all_tools())
+    cb_tools = cb_mcp_client.get_all_tools() if cb_mcp_client else []
+    pg_tools = pg_mcp_client.get_all_tools() if pg_mcp_client else []
+    cl.user_session.set("tool_counts", (len(cb_tools), len(pg_tools)))
+    cl.user_session.set("mcp_generation", _mcp_generation)
     
-    agent = Agent(
+    return Agent(
         name="DBAgent",
         role="Database Expert",
+        # Keep this static (no timestamps/ids) so the cached prefix stays valid
         instructions=[load_system_prompt()],
-        llm=DaprChatClient(
-            component_name=os.getenv("DAPR_LLM_COMPONENT_DEFAULT", "openai"),
-            provider=os.getenv("DAPR_LLM_PROVIDER", "openai"),
-            timeout=180
-        ),
-        tools=all_tools
+        llm=get_llm(),
+        tools=cb_tools + pg_tools,
+        memory=AgentMemoryConfig(store=memory) if memory is not None else None
     )
 
 
+async def init_agent(reconnect: bool = False, memory: Optional[MemoryBase] = None):
+    """Initialize or reset this session's agent, reusing the shared MCP connections.
+    
+    With ``reconnect=True`` the shared MCP clients are cycled first. ``memory``
+    keeps the session's conversation history; otherwise the agent starts fresh.
+    """
+    cl.user_session.set("agent", None)
+    
+    if reconnect:
+        await reset_mcp_clients()
+    else:
+        await ensure_mcp_clients()
+    cl.user_session.set("agent", build_agent(memory))
+
+
+async def warm_mcp_clients():
+    """Connect the shared MCP clients ahead of the first chat (best effort)."""
+    try:
+        await ensure_mcp_clients()
+    except Exception as e:
+        logger.warning("MCP pre-warm failed, will connect on first chat: %s", e)
+
+
+# Pre-warm on Chainlit versions that expose an app startup hook
+if hasattr(cl, "on_app_startup"):
+    @cl.on_app_startup
+    async def on_app_startup():
+        """Start connecting MCP servers without delaying server startup."""
+        global _warmup_task
+        _warmup_task = asyncio.create_task(warm_mcp_clients())
+
+
 @cl.on_chat_start
 async def on_chat_start():
     """Initialize agent when chat starts."""
@@ -100,12 +359,11 @@ async def on_chat_start():
         await init_agent()
         
         # Build status message based on active DBs
+        cb_tools_count, pg_tools_count = cl.user_session.get("tool_counts")
         status_parts = []
         if cb_mcp_client:
-            cb_tools_count = len(cb_mcp_client.get_all_tools())
             status_parts.append(f"Couchbase MCP ({cb_tools_count} tools)")
         if pg_mcp_client:
-            pg_tools_count = len(pg_mcp_client.get_all_tools())
             status_parts.append(f"PostgreSQL MCP ({pg_tools_count} tools)")
         
         await cl.Message(
@@ -122,76 +380,152 @@ async def on_chat_start():
 
 @cl.on_chat_end
 async def on_chat_end():
-    """Cleanup MCP connections when chat ends."""
-    global cb_mcp_client, pg_mcp_client
-    for client in [cb_mcp_client, pg_mcp_client]:
-        if client:
-            try:
-                await client.close()
-            except RuntimeError:
-                pass
-    cb_mcp_client = None
-    pg_mcp_client = None
+    """Drop this session's agent - shared MCP connections are kept for other sessions."""
+    cl.user_session.set("agent", None)
 
 
 @cl.on_message
 async def on_message(message: cl.Message):
     """Handle incoming user messages."""
+    session_id = cl.context.session.id
+    if session_id in _pending_runs:
+        await cl.Message(content="⏳ Still working on your previous question - please wait for it to finish.").send()
+        return
+    
+    agent: Optional[Agent] = cl.user_session.get("agent")
+    
+    # Another session reconnected the shared MCP clients - rebuild over the
+    # new tools, keeping this session's conversation history
+    if agent is not None and cl.user_session.get("mcp_generation") != _mcp_generation:
+        try:
+            await init_agent(memory=agent.memory)
+        except Exception as e:
+            # Keep the old agent (and its history) so the next message retries
+            cl.user_session.set("agent", agent)
+            await cl.Message(content=f"Failed to reconnect to MCP servers: {e}").send()
+            return
+        agent = cl.user_session.get("agent")
+    
     if agent is None:
         await cl.Message(content="Agent not ready. Please refresh the page.").send()
         return
     
+    # Only a session's first question is free of conversation context, so
+    # only first-turn answers are shared through the cache
+    first_turn = not agent.memory.get_messages()
+    key = response_cache_key(message.content)
+    cached = get_cached_response(key) if first_turn else None
+    if cached is not None:
+        # Record the exchange so follow-ups can refer to the cached answer
+        agent.memory.add_messages([
+            {"role": "user", "content": message.content},
+            {"role": "assistant", "content": cached}
+        ])
+        await cl.Message(content=cached).send()
+        return
+    
+    # Send an empty message right away so the UI shows progress while the
+    # agent works, then fill it in (DaprChatClient cannot stream tokens)
+    msg = cl.Message(content="")
+    await msg.send()
+    
+    # The run is shielded so a disconnect or timeout here does not cancel
+    # in-flight tool work; it fills in msg (and the cache) when it finishes
+    run = asyncio.ensure_future(answer_into(agent, message.content, msg))
+    if first_turn:
+        run.add_done_callback(functools.partial(cache_run_result, key, _mcp_generation))
+    _pending_runs[session_id] = run
+    run.add_done_callback(lambda _: _pending_runs.pop(session_id, None))
+    
     try:
-        response = await agent.run(message.content)
-        await cl.Message(content=response.content or "No response generated.").send()
-    except Exception as e:
-        await cl.Message(content=f"Error: {e}").send()
+        await asyncio.wait_for(asyncio.shield(run), timeout=AGENT_RUN_TIMEOUT)
+    except asyncio.TimeoutError:
+        if not run.done():
+            msg.content = "⏱️ Still working on it - the answer will appear here when it is ready."
+            await msg.update()
+    except asyncio.CancelledError:
+        # Stop button or disconnect: the shielded run carries on and fills msg later
+        if not run.done():
+            msg.content = "⏹️ Stopped waiting - the answer will appear here when it is ready."
+            await asyncio.shield(msg.update())
+        raise
 
 
 @cl.action_callback("reset_agent")
 async def on_reset_action(action: cl.Action):
     """Handle Reset button click."""
-    await cl.Message(content="🔄 Resetting agent...").send()
+    msg = cl.Message(content="🔄 Resetting agent...")
+    await msg.send()
     try:
-        await init_agent()
-        await cl.Message(content=f"✅ Agent reset! Ready to query '{CB_BUCKET_NAME}'.").send()
+        await init_agent(reconnect=True)
+        msg.content = f"✅ Agent reset! Ready to query '{_cfg.bucket}'."
     except Exception as e:
-        await cl.Message(content=f"❌ Reset failed: {e}").send()
+        msg.content = f"❌ Reset failed: {e}"
+    await msg.update()
 
 
 @cl.action_callback("reload_env")
 async def on_reload_env_action(action: cl.Action):
     """Handle Reload Env button click - reload .env and reinitialize agent."""
-    global CB_MCP_SERVER_URL, PG_MCP_SERVER_URL, CB_MCP_ACTIVE, PG_MCP_ACTIVE, CB_BUCKET_NAME
+    global _cfg
     
-    await cl.Message(content="📥 Reloading environment...").send()
+    msg = cl.Message(content="📥 Reloading environment...")
+    await msg.send()
     
     try:
         # Reload .env file (override=True to update existing values)
         load_dotenv(override=True)
         
-        # Update global config variables
-        CB_MCP_SERVER_URL = os.getenv("CB_MCP_SERVER_URL", "http://localhost:8000/sse")
-        PG_MCP_SERVER_URL = os.getenv("PG_MCP_SERVER_URL", "http://localhost:8003/sse")
-        CB_MCP_ACTIVE = os.getenv("CB_MCP_ACTIVE", "true").lower() == "true"
-        PG_MCP_ACTIVE = os.getenv("PG_MCP_ACTIVE", "true").lower() == "true"
-        CB_BUCKET_NAME = os.getenv("CB_BUCKET_NAME", "travel-sample")
+        old_cfg, old_prompt = _cfg, load_system_prompt()
+        
+        # Swap in the new config in one step
+        _cfg = load_config()
+        
+        # Re-read the prompt files too - they depend on cb_active and may have been edited
+        load_system_prompt.cache_clear()
+        system_prompt_digest.cache_clear()
+        
+        # Nothing changed and everything is connected - keep the live connections and agent
+        if (
+            _cfg == old_cfg
+            and load_system_prompt() == old_prompt
+            and _mcp_ready.is_set()
+            and cl.user_session.get("agent") is not None
+        ):
+            msg.content = f"✅ Environment unchanged. CB_ACTIVE={_cfg.cb_active}, PG_ACTIVE={_cfg.pg_active}"
+            await msg.update()
+            return
         
         # Reinitialize agent with new config
-        await init_agent()
+        await init_agent(reconnect=True)
         
-        await cl.Message(content=f"✅ Environment reloaded! CB_ACTIVE={CB_MCP_ACTIVE}, PG_ACTIVE={PG_MCP_ACTIVE}").send()
+        msg.content = f"✅ Environment reloaded! CB_ACTIVE={_cfg.cb_active}, PG_ACTIVE={_cfg.pg_active}"
     except Exception as e:
-        await cl.Message(content=f"❌ Reload failed: {e}").send()
+        msg.content = f"❌ Reload failed: {e}"
+    await msg.update()
+
+
+async def graceful_exit(timeout: float = 1.0):
+    """Close MCP clients (bounded by ``timeout``), flush output and exit."""
+    # asyncio.wait() returns on time even if the teardown ignores cancellation,
+    # unlike wait_for(), which waits for the cancelled close to finish
+    cleanup = asyncio.ensure_future(close_mcp_clients())
+    _, pending = await asyncio.wait({cleanup}, timeout=timeout)
+    if pending:
+        logger.warning("MCP cleanup timed out after %.1fs, exiting anyway", timeout)
+    
+    # os._exit() skips interpreter cleanup, so flush logs and stdio first
+    logging.shutdown()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    
+    # sys.exit() would only raise SystemExit inside this handler task,
+    # which Chainlit catches - os._exit() is what actually stops the server
+    os._exit(0)
 
 
 @cl.action_callback("exit_app")
 async def on_exit_action(action: cl.Action):
     """Handle Exit button click - shutdown the app."""
-    import os as _os
-    
     await cl.Message(content="🚪 Shutting down application...").send()
-    
-    # Use os._exit() for immediate termination
-    # MCP cleanup is skipped as it fails across async task contexts
-    _os._exit(0)
+    await graceful_exit()